@@ -1,6 +1,15 @@
 import os
 from flask import Flask
-from .routes import main
+from werkzeug.wsgi import FileWrapper
+from .routes import main, ALLOWED_EXT, EXT_TO_TYPE
+
+# Chunk size for streaming downloads when the server has no native file wrapper (1MB)
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+
+def large_file_wrapper(file, buffer_size=8192):
+    """Wrap a file for WSGI responses, reading at least DOWNLOAD_CHUNK_SIZE per chunk"""
+    return FileWrapper(file, max(buffer_size, DOWNLOAD_CHUNK_SIZE))
 
 
 def create_app():
@@ -16,14 +25,28 @@ def create_app():
     # Maximum size
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+    # Let the front web server send file bodies (X-Sendfile) when enabled
+    app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
     # Allowed file extensions
-    app.config['ALLOWED_EXTENSIONS'] = {'pdf', 'xlsx', 'xls', 'docx'}
+    app.config['ALLOWED_EXTENSIONS'] = ALLOWED_EXT
 
-    # Create upload directories if they don't exist
-    upload_dirs = ['uploads/pdf', 'uploads/excel', 'uploads/docx', 'data']
+    # Create upload directories if they don't exist (once, at startup)
+    upload_dirs = [os.path.join(app.config['UPLOAD_FOLDER'], file_type)
+                   for file_type in sorted(set(EXT_TO_TYPE.values()))]
+    upload_dirs.append('data')
     for directory in upload_dirs:
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
+
+    # Stream downloads in large chunks, unless the server provides its own
+    # (e.g. sendfile based) file wrapper
+    inner_wsgi_app = app.wsgi_app
+
+    def wsgi_app(environ, start_response):
+        environ.setdefault('wsgi.file_wrapper', large_file_wrapper)
+        return inner_wsgi_app(environ, start_response)
+
+    app.wsgi_app = wsgi_app
 
     app.register_blueprint(main)
 
@@ -1,86 +1,266 @@
-from flask import Blueprint, render_template, request, jsonify, current_app, send_file
+from flask import Blueprint, render_template, request, jsonify, current_app, send_file, make_response
 import os
 import json
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import uuid
-import magic
+import shutil
+import stat
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import puremagic
 
 # Create Blueprint
 main = Blueprint('main', __name__)
 
+# Number of leading bytes sniffed to detect the real file type
+HEADER_SIZE = 8192
 
-# Helper function to check allowed file types
-def allowed_file(filename):
-    """Check if uploaded file type is allowed"""
+# Buffer size used when copying uploads to disk (4MB)
+COPY_BUFFER_SIZE = 1 << 22
+
+# Maximum number of files saved concurrently per upload request
+MAX_UPLOAD_WORKERS = 8
+
+# How long clients may cache downloaded files (seconds)
+DOWNLOAD_MAX_AGE = 3600
+
+# Path of the JSON file holding uploaded files metadata
+METADATA_FILE = 'data/files_metadata.json'
+
+# Version of the /files page output, from the newest mtime of its code and templates,
+# so a deploy invalidates ETags issued for the old HTML
+_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+FILES_VIEW_VERSION = max(
+    os.stat(path).st_mtime_ns
+    for path in (__file__, os.path.join(_TEMPLATE_DIR, 'base.html'), os.path.join(_TEMPLATE_DIR, 'files.html'))
+)
+
+# In-process metadata cache (data, by_stored, by_id), invalidated when the file's
+# (inode, size, mtime) changes. Cached objects are shared and never modified in place
+_meta_cache = None
+_meta_key = None
+_meta_lock = threading.Lock()
+
+
+# Map of allowed file extensions to their type category
+EXT_TO_TYPE = {'pdf': 'pdf', 'xlsx': 'excel', 'xls': 'excel', 'docx': 'docx'}
+ALLOWED_EXT = frozenset(EXT_TO_TYPE)
+
+# Units used when displaying file sizes
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
+def get_file_extension(filename):
+    """Get the lowercase file extension, or an empty string if there is none"""
     # rsplit(): Start split from the RIGHT of the string
     # split(): Start split from the LEFT
     # params: character to split, maximum time of splitting (1 means only split 1 time)
-    return '.' in filename and \
-        filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
+    return filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+
+
+# Helper function to check allowed file types
+def allowed_file(filename):
+    """Check if uploaded file type is allowed"""
+    return get_file_extension(filename) in ALLOWED_EXT
 
 
 def get_file_type(filename):
     """Get file type category for organization"""
-    ext = filename.rsplit('.', 1)[1].lower()
-    if ext == 'pdf':
-        return 'pdf'
-    elif ext in ['xlsx', 'xls']:
-        return 'excel'
-    elif ext == 'docx':
-        return 'docx'
-    return 'unknown'
+    return EXT_TO_TYPE.get(get_file_extension(filename), 'unknown')
 
 
 def format_file_size(size_bytes):
     """Convert bytes to human readable format"""
-    if size_bytes == 0:
+    if size_bytes <= 0:
         return "0 B"
-    size_names = ["B", "KB", "MB", "GB"]
-    import math
-    i = int(math.floor(math.log(size_bytes, 1024)))
-    p = math.pow(1024, i)
-    s = round(size_bytes / p, 2)
-    return f"{s} {size_names[i]}"
+    # Each unit is 2^10 times the previous one, so the bit length gives the unit index
+    i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    s = round(size_bytes / (1 << (10 * i)), 2)
+    return f"{s} {SIZE_UNITS[i]}"
+
+
+def _build_metadata_cache(metadata):
+    """Index file metadata entries by stored name and by id"""
+    files_list = metadata.get('files', [])
+    by_stored = {f['stored_name']: f for f in files_list}
+    by_id = {f['id']: f for f in files_list}
+    return metadata, by_stored, by_id
+
+
+def _stat_key(st):
+    """Identify a version of the metadata file from its stat result"""
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+def _metadata_file_mode():
+    """Permission bits for a rewritten metadata file: the current file's, else the umask default"""
+    try:
+        return stat.S_IMODE(os.stat(METADATA_FILE).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+
+def _load_files_index_locked():
+    """Load file metadata plus lookup dicts; the caller must hold _meta_lock"""
+    global _meta_cache, _meta_key
+    try:
+        st = os.stat(METADATA_FILE)
+        if _stat_key(st) == _meta_key and _meta_cache is not None:
+            return _meta_cache
+
+        with open(METADATA_FILE, 'r') as f:
+            metadata = json.load(f)
+        # Files are kept newest first on insert; this only reorders lists
+        # written in upload order, and is near-free on an already sorted list
+        metadata.get('files', []).sort(key=lambda x: x.get('upload_date', ''), reverse=True)
+        _meta_cache = _build_metadata_cache(metadata)
+        _meta_key = _stat_key(st)
+        return _meta_cache
+    except (json.JSONDecodeError, FileNotFoundError):
+        return {'files': []}, {}, {}
+
+
+def _save_files_metadata_locked(metadata):
+    """Save file metadata and refresh the cache; the caller must hold _meta_lock"""
+    global _meta_cache, _meta_key
+    # Write to a unique temp file and swap it in, so neither a crash nor another
+    # worker process writing at the same time can leave partial JSON in place
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(METADATA_FILE), suffix='.tmp')
+    try:
+        # mkstemp creates the file as 0600; keep the metadata file readable as before
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, _metadata_file_mode())
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+            # The rename keeps inode, size and mtime, so this key matches the cached bytes
+            key = _stat_key(os.fstat(f.fileno()))
+        os.replace(tmp_file, METADATA_FILE)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    _meta_cache = _build_metadata_cache(metadata)
+    _meta_key = key
+
+
+def load_files_index():
+    """Load file metadata plus lookup dicts, reusing the cached copy if unchanged.
+
+    The returned objects are shared between requests and must not be modified.
+    """
+    with _meta_lock:
+        return _load_files_index_locked()
 
 
 def load_files_metadata():
-    """Load file metadata from JSON file"""
-    metadata_file = 'data/files_metadata.json'
-    if os.path.exists(metadata_file):
-        try:
-            with open(metadata_file, 'r') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, FileNotFoundError):
-            return {'files': []}
-    return {'files': []}
+    """Load a copy of file metadata that the caller may modify"""
+    metadata = load_files_index()[0]
+    return {**metadata, 'files': list(metadata.get('files', []))}
 
 
 def save_files_metadata(metadata):
-    """Save file metadata to JSON file"""
-    metadata_file = 'data/files_metadata.json'
-    os.makedirs('data', exist_ok=True)
-    with open(metadata_file, 'w') as f:
-        json.dump(metadata, f, indent=2, default=str)
+    """Save file metadata to JSON file and refresh the cache"""
+    with _meta_lock:
+        _save_files_metadata_locked(metadata)
+
+
+def update_files_metadata(update):
+    """Replace the files list with update(files_list) and save it.
+
+    The latest metadata is reloaded, updated and written under _meta_lock, so
+    concurrent requests in this process can't drop each other's changes.
+    """
+    with _meta_lock:
+        metadata = _load_files_index_locked()[0]
+        files_list = update(list(metadata.get('files', [])))
+        _save_files_metadata_locked({**metadata, 'files': files_list})
 
 
-def validate_file_content(file_path, expected_type):
-    """Validate file content matches expected type using python-magic"""
+def validate_header(head_bytes, expected_type):
+    """Validate file header bytes match expected type using puremagic"""
+    # Empty files have no content to match
+    if not head_bytes:
+        return False
+
+    try:
+        # Sniff the bytes alone; formats sharing a header (e.g. xlsx/docx) all show up as matches
+        detected = {match.mime_type for match in puremagic.magic_string(head_bytes)}
+    except puremagic.PureError:
+        # Header doesn't match any known file type
+        return False
+
+    # Define expected MIME types
+    expected_mimes = {
+        'pdf': ['application/pdf'],
+        'excel': ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                  'application/vnd.ms-excel',
+                  'application/excel'],
+        'docx': ['application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+    }
+
+    # Office files are ZIP (xlsx/docx) or OLE2 (xls) containers; when only the
+    # container is recognised, rely on the already-checked file extension
+    container_mimes = {
+        'excel': ['application/zip', 'application/x-ole-storage'],
+        'docx': ['application/zip']
+    }
+
+    accepted = expected_mimes.get(expected_type, []) + container_mimes.get(expected_type, [])
+    return not detected.isdisjoint(accepted)
+
+
+def save_uploaded_file(file, file_extension, file_type, upload_folder, upload_date):
+    """Validate and save a single uploaded file, returning (metadata, error)"""
     try:
-        file_type = magic.from_file(file_path, mime=True)
-
-        # Define expected MIME types
-        expected_mimes = {
-            'pdf': ['application/pdf'],
-            'excel': ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                      'application/vnd.ms-excel'],
-            'docx': ['application/vnd.openxmlformats-officedocument.wordprocessingml.document']
+        # Get file info
+        original_filename = file.filename
+
+        # Generate unique filename to prevent conflicts
+        file_id = uuid.uuid4()
+        unique_filename = f"{file_id.hex[:8]}_{secure_filename(original_filename)}"
+
+        # Type-specific directory (created in create_app)
+        upload_dir = os.path.join(upload_folder, file_type)
+
+        # Validate file content from its header before saving (security check)
+        head = file.stream.read(HEADER_SIZE)
+        file.stream.seek(0)
+        if not validate_header(head, file_type):
+            return None, f"{original_filename}: File content doesn't match extension"
+
+        # Save file
+        file_path = os.path.join(upload_dir, unique_filename)
+        with open(file_path, 'wb') as out:
+            # Hint the kernel that the file is written sequentially (Linux only)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(out.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            shutil.copyfileobj(file.stream, out, COPY_BUFFER_SIZE)
+
+        # Get file size
+        file_size = os.path.getsize(file_path)
+
+        # Create metadata entry
+        file_metadata = {
+            'id': str(file_id),
+            'original_name': original_filename,
+            'stored_name': unique_filename,
+            'stored_path': file_path,
+            'file_type': file_type,
+            'file_size': file_size,
+            'formatted_size': format_file_size(file_size),
+            'upload_date': upload_date,
+            'file_extension': file_extension
         }
 
-        return file_type in expected_mimes.get(expected_type, [])
-    except:
-        # If magic fails, skip validation (fallback)
-        return True
+        return file_metadata, None
+
+    except Exception as e:
+        return None, f"{file.filename}: {str(e)}"
 
 
 @main.route('/')
@@ -103,68 +283,42 @@ def upload():
                     'message': 'No files selected'
                 }), 400
 
-            # Load existing metadata
-            metadata = load_files_metadata()
-            uploaded_count = 0
+            new_entries = []
             upload_errors = []
 
+            # Check extensions up front, then save valid files in parallel
+            valid_files = []
             for file in uploaded_files:
                 if file and file.filename != '':
-                    try:
-                        # Validate file type
-                        if not allowed_file(file.filename):
-                            upload_errors.append(f"{file.filename}: Invalid file type")
+                    # Split the extension once and map it straight to its type
+                    file_extension = get_file_extension(file.filename)
+                    file_type = EXT_TO_TYPE.get(file_extension)
+                    if file_type is None:
+                        upload_errors.append(f"{file.filename}: Invalid file type")
+                        continue
+                    valid_files.append((file, file_extension, file_type))
+
+            if valid_files:
+                upload_folder = current_app.config['UPLOAD_FOLDER']
+                # All files in one request share the same upload timestamp
+                upload_date = datetime.now().isoformat(' ', 'seconds')
+                workers = min(MAX_UPLOAD_WORKERS, len(valid_files))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = executor.map(
+                        lambda item: save_uploaded_file(*item, upload_folder, upload_date), valid_files)
+
+                    for file_metadata, error in results:
+                        if error:
+                            upload_errors.append(error)
                             continue
 
-                        # Get file info
-                        original_filename = file.filename
-                        file_type = get_file_type(original_filename)
+                        new_entries.append(file_metadata)
 
-                        # Generate unique filename to prevent conflicts
-                        file_extension = original_filename.rsplit('.', 1)[1].lower()
-                        unique_filename = f"{uuid.uuid4().hex[:8]}_{secure_filename(original_filename)}"
+            uploaded_count = len(new_entries)
 
-                        # Create type-specific directory
-                        upload_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], file_type)
-                        os.makedirs(upload_dir, exist_ok=True)
-
-                        # Save file
-                        file_path = os.path.join(upload_dir, unique_filename)
-                        file.save(file_path)
-
-                        # Get file size
-                        file_size = os.path.getsize(file_path)
-
-                        # Validate file content (security check)
-                        if not validate_file_content(file_path, file_type):
-                            os.remove(file_path)  # Remove invalid file
-                            upload_errors.append(f"{original_filename}: File content doesn't match extension")
-                            continue
-
-                        # Create metadata entry
-                        file_metadata = {
-                            'id': str(uuid.uuid4()),
-                            'original_name': original_filename,
-                            'stored_name': unique_filename,
-                            'stored_path': file_path,
-                            'file_type': file_type,
-                            'file_size': file_size,
-                            'formatted_size': format_file_size(file_size),
-                            'upload_date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            'file_extension': file_extension
-                        }
-
-                        # Add to metadata
-                        metadata['files'].append(file_metadata)
-                        uploaded_count += 1
-
-                    except Exception as e:
-                        upload_errors.append(f"{file.filename}: {str(e)}")
-                        continue
-
-            # Save updated metadata
+            # Save updated metadata, prepending the new files in submitted order (newest first)
             if uploaded_count > 0:
-                save_files_metadata(metadata)
+                update_files_metadata(lambda files_list: new_entries + files_list)
 
             # Prepare response
             if uploaded_count > 0:
@@ -199,14 +353,27 @@ def upload():
 def files():
     """Display list of uploaded files"""
     try:
-        # Load file metadata
-        metadata = load_files_metadata()
-        files_list = metadata.get('files', [])
+        # The page only changes with the metadata file or the app itself, so derive the ETag from both
+        try:
+            st = os.stat(METADATA_FILE)
+            etag = f"{FILES_VIEW_VERSION:x}-{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"
+        except FileNotFoundError:
+            etag = None
+
+        if etag and request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            # Load file metadata (already sorted newest first)
+            metadata = load_files_metadata()
+            files_list = metadata.get('files', [])
 
-        # Sort files by upload date (newest first)
-        files_list.sort(key=lambda x: x.get('upload_date', ''), reverse=True)
+            response = make_response(render_template('files.html', files=files_list))
 
-        return render_template('files.html', files=files_list)
+        if etag:
+            response.set_etag(etag, weak=True)
+            # Always revalidate; a matching ETag is answered with a cheap 304
+            response.cache_control.no_cache = True
+        return response
 
     except Exception as e:
         # If there's an error loading files, show empty list
@@ -217,16 +384,9 @@ def files():
 def download(filename):
     """Download specific file"""
     try:
-        # Load metadata to find file
-        metadata = load_files_metadata()
-        files_list = metadata.get('files', [])
-
         # Find file by stored name
-        target_file = None
-        for file_info in files_list:
-            if file_info['stored_name'] == filename:
-                target_file = file_info
-                break
+        _, by_stored, _ = load_files_index()
+        target_file = by_stored.get(filename)
 
         if not target_file:
             return jsonify({
@@ -234,18 +394,28 @@ def download(filename):
                 'message': 'File not found'
             }), 404
 
-        # Check if file exists on disk
-        if not os.path.exists(target_file['stored_path']):
+        # Stored paths are relative to the working directory, while send_file resolves
+        # relative paths against the app root, so resolve the path once here
+        file_path = os.path.abspath(target_file['stored_path'])
+
+        # Check if file exists on disk (the stat is reused for the cache headers)
+        try:
+            st = os.stat(file_path)
+        except FileNotFoundError:
             return jsonify({
                 'status': 'error',
                 'message': 'File not found on disk'
             }), 404
 
-        # Send file
+        # Send file, letting clients revalidate with If-None-Match / If-Modified-Since
         return send_file(
-            target_file['stored_path'],
+            file_path,
             as_attachment=True,
-            download_name=target_file['original_name']
+            download_name=target_file['original_name'],
+            conditional=True,
+            etag=f"{st.st_ino}-{st.st_size}-{int(st.st_mtime)}",
+            last_modified=st.st_mtime,
+            max_age=DOWNLOAD_MAX_AGE
         )
 
     except Exception as e:
@@ -259,17 +429,9 @@ def download(filename):
 def delete_file(file_id):
     """Delete specific file"""
     try:
-        # Load metadata
-        metadata = load_files_metadata()
-        files_list = metadata.get('files', [])
-
-        # Find and remove file
-        target_file = None
-        for i, file_info in enumerate(files_list):
-            if file_info['id'] == file_id:
-                target_file = file_info
-                files_list.pop(i)
-                break
+        # Find file by id
+        _, _, by_id = load_files_index()
+        target_file = by_id.get(file_id)
 
         if not target_file:
             return jsonify({
@@ -277,12 +439,14 @@ def delete_file(file_id):
                 'message': 'File not found'
             }), 404
 
-        # Delete file from disk
-        if os.path.exists(target_file['stored_path']):
+        # Delete file from disk first, so a failure leaves the metadata untouched
+        try:
             os.remove(target_file['stored_path'])
+        except FileNotFoundError:
+            pass
 
         # Save updated metadata
-        save_files_metadata(metadata)
+        update_files_metadata(lambda files_list: [f for f in files_list if f['id'] != file_id])
 
         return jsonify({
             'status': 'success',